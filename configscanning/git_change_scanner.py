@@ -10,7 +10,7 @@ import importlib.util
 import json
 import logging
 import os
-import shutil
+import re
 import sys
 from collections.abc import Callable, Iterable, Mapping
 from pathlib import Path
@@ -127,7 +127,7 @@ def pull(app_id: int | str | None, pkey: str | None, clonedrepo: GitHubRepo) ->
         # We write this to a file so that, when we scan, the config scan can report
         # that it has scanned up to a time measured with the same clock as the push
         # time we record here.
-        gh_repo_data: Repository = clonedrepo.get_github_repo()
+        gh_repo_data: Repository = clonedrepo.get_github_repo(refresh=True)
         pushed_time = int(gh_repo_data.pushed_at.timestamp())
         os.makedirs(Path(clonedrepo.location).parent, exist_ok=True)
         with open(f"{clonedrepo.location}.upstream_push_time", "w", encoding="ascii") as fobj:
@@ -143,16 +143,13 @@ def pull(app_id: int | str | None, pkey: str | None, clonedrepo: GitHubRepo) ->
         }
 
 
+# Matches the names of files the config scanner should scan.
+SCANNABLE_FILE_RE = re.compile(r"\.(yaml|yml|json|cwl|html|txt)\Z")
+
+
 def scannable_file(fname: str) -> bool:
     """This returns true if 'fname' is the name of a file the config scanner should scan."""
-    return (
-        fname.endswith(".yaml")
-        or fname.endswith(".yml")
-        or fname.endswith(".json")
-        or fname.endswith(".cwl")
-        or fname.endswith(".html")
-        or fname.endswith(".txt")
-    )
+    return SCANNABLE_FILE_RE.search(fname) is not None
 
 
 class _ScannerProtocol(Protocol):
@@ -163,7 +160,7 @@ class _ScannerProtocol(Protocol):
 def config_scan(
     clonedrepo: GitHubRepo,
     branch_scanner_objs: Mapping[str, Iterable[_ScannerProtocol]],
-    scan_filter: Callable[[str], bool] = scannable_file,
+    scan_filter: Callable[[str], bool] | re.Pattern[str] = SCANNABLE_FILE_RE,
     full_scan: bool = False,
 ) -> dict[str, Any]:
     """Scans and processes the config files in the cloned repo"""
@@ -295,8 +292,7 @@ def main(parser: argparse.ArgumentParser | None = None) -> None:
     if args.delete:
         with clonedrepo.lock:
             # Delete our clone from disk.
-            if os.access(clonedrepo.location, 0):
-                shutil.rmtree(clonedrepo.location)
+            clonedrepo.delete_clone()
 
         patch["status"]["clonePosition"] = None
 
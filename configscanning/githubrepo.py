@@ -1,36 +1,114 @@
 """Tools for use with a specific GitHub repo"""
 
+import asyncio
+import functools
 import logging
 import os
+import re
 import shutil
-from collections.abc import Callable
+import threading
+import time
+from collections.abc import Callable, Iterable
 from pathlib import Path
-from typing import Any
+from typing import Any, ClassVar
 from urllib.parse import ParseResult, urlparse
 
 import pygit2
 from filelock import FileLock
-from github import Auth, Github, GithubIntegration
+from github import Auth, Github, GithubIntegration, UnknownObjectException
 from github.Repository import Repository
 from pygit2.enums import BranchType, ObjectType, ResetMode
 
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 
+# How long (in seconds) we trust our knowledge of which branches exist in GitHub.
+AVAILABLE_BRANCHES_TTL = 60
+
+
+@functools.lru_cache(maxsize=128)
+def _open_repo(location: str) -> pygit2.Repository:
+    """
+    Opens the clone at location, raising pygit2.GitError if there isn't a valid one.
+
+    Handles are shared within the process. _open_repo.cache_clear() must be called after deleting
+    a clone.
+    """
+    return pygit2.Repository(location, pygit2.GIT_REPOSITORY_OPEN_NO_SEARCH)
+
+
+class _FlockLock:
+    """
+    A reentrant inter-process lock using flock(2) on a lock file.
+
+    This blocks in the kernel rather than polling, as FileLock does. The lock file is kept (and
+    kept open) because the clone directory itself may be deleted and recreated while the lock is
+    held. FileLock also uses flock on Unix, so the two interoperate.
+    """
+
+    def __init__(self, lock_file: str) -> None:
+        self.lock_file = lock_file
+        self._fd: int | None = None
+        self._depth = 0
+        self._thread_lock = threading.RLock()
+
+    def __enter__(self) -> "_FlockLock":
+        assert fcntl is not None
+        self._thread_lock.acquire()
+        try:
+            if self._depth == 0:
+                if self._fd is None:
+                    os.makedirs(os.path.dirname(self.lock_file), exist_ok=True)
+                    self._fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        assert fcntl is not None
+        self._depth -= 1
+        if self._depth == 0:
+            assert self._fd is not None
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def __del__(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+
 
 # pygit2 uses the C wrapper and pylint falsely things many things are not defined because of this.
 # pylint: disable=no-member
 class GitHubRepo:
     """This represents a cloned repo"""
 
+    # These are shared by all instances so that processing many repos in the same organization
+    # does not repeat the app installation lookup and repo lookup each time.
+    _installation_cache: ClassVar[dict[tuple[int | str | None, str], Github]] = {}
+    _repo_cache: ClassVar[dict[tuple[int | str | None, str, str], Repository]] = {}
+
     location: Path
+    _location_str: str
     parent_dir: Path | None
     repourl: str | None
     repourlobj: ParseResult
     gh_org: str
     gh_reponame: str
-    branches_to_fetch: set[str]
+    _branches_to_fetch: set[str]
+    shallow_depth: int | None
+    _app_id: int | str | None
     _github: Github | None
     _gh_repo: Repository | None
+    _available_branches_cache: tuple[float, frozenset[str], set[str]] | None
+    _remote_callbacks: pygit2.RemoteCallbacks | None
+    _remote_callbacks_token: str | None
 
     # This is a gitpython Repo if a clone exists, otherwise None
     repo: pygit2.Repository | None
@@ -41,6 +119,7 @@ class GitHubRepo:
         parent_dir: str | Path | None = None,
         repourl: str | None = None,
         branches_to_fetch: set[str] | None = None,
+        shallow_depth: int | None = None,
     ) -> None:
         """
         This represents a repo to be cloned and kept up-to-date within the AIPIPE platform.
@@ -58,6 +137,9 @@ class GitHubRepo:
               repourl (str): https URL for the repo - MUST be of form
                              https://github-host-name/orgname/reponame.git
               branches_to_fetch (set[str]): list of branch names to fetch - these MUST exist
+              shallow_depth (int): if not None, fetch only this many commits of history from the
+                                   tip of each branch. Scanning only needs the branch tips and
+                                   our own scan tags, so this can save a lot of transfer.
         """
         if branches_to_fetch is None:
             branches_to_fetch = {"main"}
@@ -65,10 +147,14 @@ class GitHubRepo:
         self.repourl = repourl
         self.repourlobj = urlparse(repourl or "")
         self.branches_to_fetch = branches_to_fetch
+        self.shallow_depth = shallow_depth
         self.parent_dir = Path(parent_dir) if parent_dir is not None else None
+        self._app_id = None
         self._github = None
         self._gh_repo = None
-        self._access_token = None
+        self._available_branches_cache = None
+        self._remote_callbacks = None
+        self._remote_callbacks_token = None
 
         path_parts = self.repourlobj.path[1:].split("/")
         self.gh_org = path_parts[0]
@@ -78,22 +164,33 @@ class GitHubRepo:
 
         if location is None:
             assert parent_dir is not None
-            self.location = Path() / parent_dir / git_host / self.gh_org / self.gh_reponame
+            self._location_str = os.path.join(parent_dir, git_host, self.gh_org, self.gh_reponame)
+            self.location = Path(self._location_str)
         else:
             self.location = Path(location)
+            self._location_str = str(self.location)
 
             if parent_dir is None:
                 self.parent_dir = self.location.parent.parent.parent
 
         try:
-            self.repo = pygit2.Repository(self.location, pygit2.GIT_REPOSITORY_OPEN_NO_SEARCH)
+            self.repo = _open_repo(self._location_str)
         except pygit2.GitError:  # pylint disable=no-member  (use of C wrapper breaks linting)
             self.repo = None
 
         assert self.parent_dir is not None
-        self.lock = FileLock(
-            self.parent_dir / ("_AIPIPE_LOCK_" + git_host + "-" + self.gh_org + "-" + self.gh_reponame),
-        )
+        lock_file = os.path.join(self.parent_dir, f"_AIPIPE_LOCK_{git_host}-{self.gh_org}-{self.gh_reponame}")
+        self.lock = _FlockLock(lock_file) if fcntl is not None else FileLock(lock_file)
+
+    @property
+    def branches_to_fetch(self) -> set[str]:
+        """The names of the branches we fetch"""
+        return self._branches_to_fetch
+
+    @branches_to_fetch.setter
+    def branches_to_fetch(self, branches: set[str]) -> None:
+        self._branches_to_fetch = branches
+        self.__dict__.pop("_refspecs_to_pull", None)
 
     @property
     def git_host(self) -> str:
@@ -113,44 +210,117 @@ class GitHubRepo:
               app_private_key (str): A private key generated for our app registration in the app
                                      management page github.com/organizations/org/settings/apps
         """
+        self._app_id = app_id
+        self._gh_repo = None
+        cache_key = (app_id, self.gh_org)
+        cached_github = GitHubRepo._installation_cache.get(cache_key)
+
         if app_id is None:
             # This works only with public repos and limited methods.
-            self._github = Github()
-            self._access_token = None
+            self._github = cached_github or Github()
         else:
-            # First we must integrate as the app, which gives us limited access.
-            auth = Auth.AppAuth(app_id, app_private_key)
-            ghi = GithubIntegration(auth=auth)
+            if cached_github is None:
+                # First we must integrate as the app, which gives us limited access.
+                auth = Auth.AppAuth(app_id, app_private_key)
+                ghi = GithubIntegration(auth=auth)
 
-            # We can use this to find the app installation (for the organization which owns the
-            # repo), then get an authenticated client object from there.
-            gh_installation = ghi.get_repo_installation(self.gh_org, self.gh_reponame)
+                # We can use this to find the app installation (for the organization which owns the
+                # repo), then get an authenticated client object from there.
+                gh_installation = ghi.get_repo_installation(self.gh_org, self.gh_reponame)
 
-            # Now we can get a full client object which can use the full API.
-            self._github = gh_installation.get_github_for_installation()
+                # Now we can get a full client object which can use the full API.
+                cached_github = gh_installation.get_github_for_installation()
 
-            # We need this token for use with gitpython so that we can clone private repos.
-            # Access the internal requester via name-mangled attribute.
-            _requester_attr = "_Github__requester"
-            self._access_token = getattr(self._github, _requester_attr).auth.token
+            self._github = cached_github
+
+        GitHubRepo._installation_cache[cache_key] = self._github
 
         assert self._github is not None
         return self._github
 
-    def get_github_repo(self) -> Repository:
-        """Returns a github.Repository object representing the repo"""
+    @property
+    def _access_token(self) -> str | None:
+        """
+        The installation access token, used with pygit2 so that we can clone private repos, or
+        None if we're not authenticated as an app.
+
+        This is read from the client every time rather than stored: the client may be shared with
+        other instances and the installation auth only refreshes the token shortly before it
+        expires.
+        """
+        if self._app_id is None or self._github is None:
+            return None
+
+        # Access the internal requester via name-mangled attribute.
+        _requester_attr = "_Github__requester"
+        return getattr(self._github, _requester_attr).auth.token
+
+    def get_github_repo(self, refresh: bool = False) -> Repository:
+        """
+        Returns a github.Repository object representing the repo.
+
+        The object may be shared with other GitHubRepo instances for the same repo. If refresh is
+        True then a previously fetched object is brought up-to-date with a (cheap) conditional
+        request.
+        """
         assert self._github is not None
         if self._gh_repo is None:
-            self._gh_repo = self._github.get_repo(f"{self.gh_org}/{self.gh_reponame}")
+            cache_key = (self._app_id, self.gh_org, self.gh_reponame)
+            self._gh_repo = GitHubRepo._repo_cache.get(cache_key)
+            if self._gh_repo is None:
+                self._gh_repo = self._github.get_repo(f"{self.gh_org}/{self.gh_reponame}")
+                GitHubRepo._repo_cache[cache_key] = self._gh_repo
+                return self._gh_repo
+
+        if refresh:
+            self._gh_repo.update()
         return self._gh_repo
 
+    @functools.cached_property
     def _refspecs_to_pull(self) -> list[str]:
         """
-        This returns a list of refspecs we should fetch from our remote, eg
+        This is the list of refspecs we should fetch from our remote, eg
           ["refs/heads/main:refs/remotes/origin/main"]
+
+        This is cached until branches_to_fetch is next assigned to.
         """
         return [f"refs/heads/{branch}:refs/remotes/origin/{branch}" for branch in self.branches_to_fetch]
 
+    def _available_branches(self) -> set[str]:
+        """
+        Returns those of self.branches_to_fetch which exist in GitHub.
+
+        Only the branches we want are queried (one request each) rather than listing every branch
+        in the repo. The result is cached for AVAILABLE_BRANCHES_TTL seconds.
+        """
+        wanted = frozenset(self.branches_to_fetch)
+        now = time.monotonic()
+        if self._available_branches_cache is not None:
+            cached_at, cached_wanted, cached_available = self._available_branches_cache
+            if now - cached_at < AVAILABLE_BRANCHES_TTL and wanted <= cached_wanted:
+                return cached_available & wanted
+
+        gh_repo = self.get_github_repo()
+        available = set()
+        for branch in wanted:
+            try:
+                gh_repo.get_branch(branch)
+            except UnknownObjectException:
+                logger.info(f"Branch {branch} does not exist in {self.repourl}")
+                continue
+            available.add(branch)
+
+        self._available_branches_cache = (now, wanted, available)
+        return available
+
+    def _get_remote_callbacks(self) -> pygit2.RemoteCallbacks:
+        """Returns callbacks for talking to our remote, reusing them until the token is refreshed"""
+        access_token = self._access_token
+        if self._remote_callbacks is None or self._remote_callbacks_token != access_token:
+            self._remote_callbacks = pygit2.RemoteCallbacks(credentials=pygit2.UserPass("none", access_token or ""))
+            self._remote_callbacks_token = access_token
+        return self._remote_callbacks
+
     def ref_positions(self) -> dict[str, Any]:
         """
         Returns a map from relevant branch/tag/... name to the commit it currently points to.
@@ -158,29 +328,49 @@ class GitHubRepo:
         """
         assert self.repo is not None
 
-        def data_for_branch(branch_name: str) -> dict[str, Any]:
-            assert self.repo is not None
-            commit_id = self.repo.branches[branch_name].target
-            commit = self.repo.get(commit_id)
+        result = {}
+        for branch_name in self.branches_to_fetch:
+            branch = self.repo.branches.local.get(branch_name)
+            if branch is None:
+                continue
+
+            commit = self.repo.get(branch.target)
             assert isinstance(commit, pygit2.Commit)
-            return {
+            result[branch.name] = {
                 "hash": commit.id,
-                "summary": commit.message.split("\n")[0],
+                "summary": commit.message.split("\n", maxsplit=1)[0],
                 "commitDate": commit.commit_time,
             }
 
-        return {
-            self.repo.branches[branch_name].name: data_for_branch(branch_name)
-            for branch_name in self.repo.branches.local
-            if branch_name in self.branches_to_fetch
+        return result
+
+    def _up_to_date_with_remote(self) -> bool:
+        """
+        Returns true if every local branch in branches_to_fetch already points to the same commit
+        as the branch in our remote. This is much cheaper than a fetch.
+        """
+        assert self.repo is not None
+        remote_heads = {
+            head.name: head.oid
+            for head in self.repo.remotes["origin"].list_heads(callbacks=self._get_remote_callbacks())
         }
+        local_positions = self.ref_positions()
+
+        return all(
+            f"refs/heads/{branch}" in local_positions
+            and local_positions[f"refs/heads/{branch}"]["hash"] == remote_heads.get(f"refs/heads/{branch}")
+            for branch in self.branches_to_fetch
+        )
 
-    def update(self) -> None:
+    def update(self, check_before_fetch: bool = True) -> None:
         """
         Updates our clone of the repo, creating it if necessary.
 
         This means that all branches in branches_to_fetch will have been fetched, but any
         other tags or branches may not have been.
+
+        If check_before_fetch is True and the clone already exists then the remote's branch
+        positions are checked first and nothing is fetched if our branches are already there.
         """
         logger.info(f"Updating repo {self.repourl} in {self.location}")
 
@@ -189,10 +379,10 @@ class GitHubRepo:
         #
         # For that reason, we can't just use the list of branches we're given, we need to remove
         # any non-existent ones.
-        gh_repo = self.get_github_repo()
-        available_branches = set(map(lambda b: b.name, gh_repo.get_branches()))
-        self.branches_to_fetch = self.branches_to_fetch & available_branches
-        refspecs = self._refspecs_to_pull()
+        available_branches = self.branches_to_fetch & self._available_branches()
+        if available_branches != self.branches_to_fetch:
+            self.branches_to_fetch = available_branches
+        refspecs = self._refspecs_to_pull
 
         with self.lock:
             logger.debug(f"Locked repo {self.repourl} in {self.location}")
@@ -200,21 +390,26 @@ class GitHubRepo:
                 # No clone or clone is invalid at time of construction.
                 # Check again now lock held.
                 try:
-                    self.repo = pygit2.Repository(self.location, pygit2.GIT_REPOSITORY_OPEN_NO_SEARCH)
+                    self.repo = _open_repo(self._location_str)
                 except pygit2.GitError:  # pylint disable=no-member
                     self.repo = None
 
+            if self.repo is not None and self.repo.is_shallow and self.shallow_depth is None:
+                # We now want full history, which libgit2 can't add to a shallow clone.
+                logger.info(f"Repo {self.repourl} in {self.location} is shallow; recloning")
+                self.repo = None
+
+            cloning = self.repo is None
             if self.repo is None:
                 logger.info(f"Repo {self.repourl} does not exist in {self.location}; cloning")
 
                 # Delete repo if it exists (in case of broken / partial clone)
-                if self.location.exists():
-                    shutil.rmtree(self.location)
+                self.delete_clone()
 
-                os.makedirs(self.location, exist_ok=True)
+                os.makedirs(self._location_str, exist_ok=True)
 
                 self.repo = pygit2.init_repository(
-                    path=self.location,
+                    path=self._location_str,
                     initial_head="main",
                 )
 
@@ -228,65 +423,124 @@ class GitHubRepo:
 
             # Repo now exists.
             assert self.repo is not None
-            #
+
+            if check_before_fetch and not cloning and self._up_to_date_with_remote():
+                logger.info(f"Repo {self.repourl} clone in {self.location} is up-to-date; not fetching")
+                return
+
             # First, fetch from remotes. ie, refs/remotes/origin/<branches> become up-to-date with
             # what's in GitHub
             logger.info(f"Fetching for repo {self.repourl} clone in {self.location}")
 
+            # All branches are fetched together so that there is one pack negotiation and one
+            # consistent update of .git/shallow when shallow_depth is set.
             transfer_progress = self.repo.remotes["origin"].fetch(
-                callbacks=pygit2.RemoteCallbacks(credentials=pygit2.UserPass("none", self._access_token or ""))
+                refspecs=refspecs,
+                callbacks=self._get_remote_callbacks(),
+                depth=self.shallow_depth or 0,
             )
 
             logger.info(f"Fetched {transfer_progress}")
 
             # Now we can move our local branches to point to the tip of the remote branches.
             # We assume we can simply fast-forward here, which should be true.
+            #
+            # Apart from the one branch we check out, this only writes refs: the working tree is
+            # updated once rather than once per branch.
+            fast_forwards: dict[str, pygit2.Commit] = {}
             for branch in self.branches_to_fetch:
                 logger.debug(f"Updating branch {branch}")
                 remote_branch: pygit2.Branch = self.repo.lookup_branch(f"origin/{branch}", BranchType.REMOTE)
                 logger.debug(f"Remote branch at {remote_branch.target}")
+                remote_commit = self.repo.get(remote_branch.target)
+                assert isinstance(remote_commit, pygit2.Commit)
 
                 if branch not in self.repo.branches.local:
                     # No local branch - create it
                     logger.info(f"Creating local branch {branch}")
-                    remote_commit = self.repo.get(remote_branch.target)
-                    assert isinstance(remote_commit, pygit2.Commit)
                     self.repo.branches.create(branch, remote_commit)
                 else:
-                    logger.info(f"Fast-forwarding local branch {branch}")
-                    self.repo.checkout(f"refs/heads/{branch}")
-                    local_branch: pygit2.Branch = self.repo.lookup_branch(branch)
-                    local_branch.set_target(remote_branch.target)
-                    self.repo.head.set_target(remote_branch.target)
+                    fast_forwards[branch] = remote_commit
+
+            primary_branch = None
+            if fast_forwards:
+                # Stay on the current branch if it moves, otherwise pick one deterministically.
+                head_branch = None
+                if not self.repo.head_is_unborn and not self.repo.head_is_detached:
+                    head_branch = self.repo.head.shorthand
+                primary_branch = head_branch if head_branch in fast_forwards else min(fast_forwards)
+
+                # This must happen before the branch is moved: libgit2 works out which files to
+                # change by comparing against the tree HEAD currently points to.
+                logger.debug(f"Checking out branch {primary_branch}")
+                self.repo.checkout_tree(fast_forwards[primary_branch])
+
+            for branch, commit in fast_forwards.items():
+                logger.info(f"Fast-forwarding local branch {branch}")
+                local_branch: pygit2.Branch = self.repo.lookup_branch(branch)
+                local_branch.set_target(commit.id)
+
+            if primary_branch is not None:
+                self.repo.set_head(f"refs/heads/{primary_branch}")
 
             logger.debug(self.ref_positions())
 
+    async def update_async(self) -> None:
+        """
+        As update(), but runs in a worker thread so that several repos can be updated at once.
+
+        The GitHub API calls and libgit2 network I/O release the GIL, so this gives real
+        concurrency.
+        """
+        await asyncio.to_thread(self.update)
+
+    def delete_clone(self) -> None:
+        """Deletes our clone from disk, if it exists. The caller must hold self.lock."""
+        if self.location.exists():
+            shutil.rmtree(self.location)
+        self.repo = None
+        _open_repo.cache_clear()
+
     def has_ref(self, ref: str) -> bool:
         """Returns true if ref (eg, 'refs/tags/tagname') is known in the repo"""
         assert self.repo is not None
         return ref in self.repo.references
 
     def changed_files(
-        self, since: str | None, until: str = "HEAD", only_matching: Callable[[str], bool] = lambda fname: True
+        self,
+        since: str | None,
+        until: str = "HEAD",
+        only_matching: Callable[[str], bool] | re.Pattern[str] | None = None,
     ) -> set[str]:
         """
         Return a set containing the paths (relative to repo root) of all files which:
           1) if 'since' is not None, have been changed between commit/ref 'since' and the current
              workdir commit, or, if 'since' is None, which exist at all in the current commit's
              tree;
-          2) when passed to the function only_matching result in a True response.
+          2) if 'only_matching' is a function, result in a True response when passed to it, or
+             if it is a compiled regex, contain a match for it (see re.search).
 
           eg, changed_files(None, lambda f: f.endswith(".yaml")) will find all yaml files in the
               current branch, whereas changed_files("refs/tags/_SCANNED_main") will find
               all files changed between tag _SCANNED_main and the current work dir.
+
+        Prefer a regex to a function where possible: regexes are matched without a
+        Python function call per changed file.
         """
         assert self.repo is not None
         if since is None:
-            deltas = self.repo.revparse_single(until).peel(pygit2.Tree).diff_to_tree().deltas
+            until_tree = self.repo.revparse_single(until).peel(pygit2.Tree)
+            deltas = until_tree.diff_to_tree(swap=True).deltas
         else:
             deltas = self.repo.diff(since, until).deltas
 
-        return {delta.new_file.path for delta in deltas if only_matching(delta.new_file.path)}
+        paths: Iterable[str] = (delta.new_file.path for delta in deltas)
+        if isinstance(only_matching, re.Pattern):
+            paths = filter(only_matching.search, paths)
+        elif only_matching is not None:
+            paths = filter(only_matching, paths)
+
+        return set(paths)
 
     def checkout_and_reset(self, ref: str) -> None:
         """Set up the working directory with what is pointing to by 'ref', deleting any existing
@@ -314,3 +568,8 @@ class GitHubRepo:
             pygit2.Signature("Config Scanner", "configscanner@ai-pipeline.org"),
             message,
         )
+
+
+async def update_all(repos: Iterable[GitHubRepo]) -> None:
+    """Updates all of the given repos concurrently. See GitHubRepo.update()."""
+    await asyncio.gather(*(repo.update_async() for repo in repos))
@@ -1,6 +1,7 @@
 """Utilities for interactive with Kubernetes (plus a bit of scope creep)"""
 
 import argparse
+import functools
 import os
 from collections.abc import Generator
 from contextlib import contextmanager
@@ -10,44 +11,86 @@ import kubernetes
 import kubernetes.dynamic
 from kubernetes.client import CoreV1Api, V1ConfigMap
 
+# Once init_k8s() has been called these are shared by all callers, so that connections are pooled
+# and API discovery is done only once per resource kind.
+_API_CLIENT: kubernetes.client.ApiClient | None = None
+_DYNAMIC_CLIENT: kubernetes.dynamic.DynamicClient | None = None
+_RESOURCES: dict[tuple[str, str], Any] = {}
+
 
 def init_k8s() -> None:
     """Load our Kubernetes config. Call this before using Kubernetes."""
+    global _API_CLIENT, _DYNAMIC_CLIENT
+
     if "KUBERNETES_SERVICE_HOST" in os.environ:
         kubernetes.config.load_incluster_config()
     else:
         kubernetes.config.load_kube_config()
 
+    _API_CLIENT = kubernetes.client.ApiClient()
+    _DYNAMIC_CLIENT = None
+    _RESOURCES.clear()
+
+
+def _read_config(k8s_client: kubernetes.client.ApiClient) -> V1ConfigMap:
+    result = CoreV1Api(k8s_client).read_namespaced_config_map("config", "namespace")
+    assert isinstance(result, V1ConfigMap)
+    return result
+
 
 def get_config() -> V1ConfigMap:
     """Returns the config configmap"""
-    with kubernetes.client.ApiClient() as k8s_client:
-        result = CoreV1Api(k8s_client).read_namespaced_config_map("config", "namespace")
-        assert isinstance(result, V1ConfigMap)
-        return result
+    if _API_CLIENT is None:
+        with kubernetes.client.ApiClient() as k8s_client:
+            return _read_config(k8s_client)
+
+    return _read_config(_API_CLIENT)
+
+
+def _shared_resource(kind: str, api_version: str) -> Any:
+    """Returns the (cached) Dynamic Client resource for the specified kind using our shared client"""
+    global _DYNAMIC_CLIENT
+
+    assert _API_CLIENT is not None
+    key = (api_version, kind)
+    if key not in _RESOURCES:
+        if _DYNAMIC_CLIENT is None:
+            _DYNAMIC_CLIENT = kubernetes.dynamic.DynamicClient(_API_CLIENT)
+        _RESOURCES[key] = _DYNAMIC_CLIENT.resources.get(api_version=api_version, kind=kind)
+    return _RESOURCES[key]
 
 
 @contextmanager
 def aipipe_resource_dclient(kind: str, api_version: str = "ai-pipeline.org/v1alpha1") -> Generator[Any]:
     """This returns a context-managed k8s Dynamic Client for the specified CRD"""
-    with kubernetes.client.ApiClient() as k8s_client:
-        dclient = kubernetes.dynamic.DynamicClient(k8s_client)
-        api = dclient.resources.get(api_version=api_version, kind=kind)
-        yield api
+    if _API_CLIENT is None:
+        with kubernetes.client.ApiClient() as k8s_client:
+            dclient = kubernetes.dynamic.DynamicClient(k8s_client)
+            yield dclient.resources.get(api_version=api_version, kind=kind)
+        return
+
+    yield _shared_resource(kind, api_version)
 
 
 def load_gh_app_creds(args: argparse.Namespace) -> tuple[int | str | None, str | None]:
     """Given our command line args, this loads the GitHub credentials specified"""
-    if os.access(args.app_id_from, 0):
-        with open(args.app_id_from, encoding="ascii") as file:
+    return _load_gh_app_creds(args.app_id_from, args.app_private_key_from)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_gh_app_creds(app_id_from: str, app_private_key_from: str) -> tuple[int | str | None, str | None]:
+    """Loads the GitHub credentials from the given files. These are read only once per process."""
+    app_id: int | str | None
+    try:
+        with open(app_id_from, "rb") as file:
             app_id = int(file.read())
-    else:
+    except FileNotFoundError:
         app_id = os.getenv("GITHUB_APP_ID")
 
-    if os.access(args.app_private_key_from, 0):
-        with open(args.app_private_key_from, encoding="ascii") as file:
-            pkey = file.read()
-    else:
+    try:
+        with open(app_private_key_from, "rb") as file:
+            pkey = file.read().decode("ascii")
+    except FileNotFoundError:
         pkey = os.getenv("GITHUB_APP_PRIVATE_KEY")
 
     return app_id, pkey
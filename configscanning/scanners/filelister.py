@@ -1,17 +1,21 @@
 """This scanner is for testing. It simply lists the names of the files it's asked to scan,
-one per line, adding them to visited_files"""
+one per line, adding them to visited_files (or to the list passed as sink)"""
 
 from typing import Any
 
-visited_files = []
+visited_files: list[Any] = []
 
 
 class Scanner:
-    def __init__(self, **kwargs: Any) -> None:
-        pass
+    def __init__(self, sink: list[Any] | None = None, **kwargs: Any) -> None:
+        # The module-level list is looked up now rather than bound as a default so that tests
+        # can replace it between scans.
+        self._sink = sink if sink is not None else visited_files
+        self._visited: list[Any] = []
 
     def scan_file(self, fname: Any, data: Any) -> None:
-        visited_files.append(fname)
+        self._visited.append(fname)
 
     def finish(self) -> None:
-        pass
+        self._sink.extend(self._visited)
+        self._visited.clear()
@@ -1,11 +1,16 @@
+import asyncio
 import os
+import re
 from pathlib import Path
 from typing import Any
 
+import pygit2
+
 # noinspection PyPackageRequirements
 import pytest
+from github import UnknownObjectException
 
-from configscanning.githubrepo import GitHubRepo
+from configscanning.githubrepo import GitHubRepo, update_all
 
 TESTDIR = (Path(__file__).parent / "scratch/configscannertest/").absolute()
 
@@ -84,7 +89,7 @@ def test_clone_public_repo_with_nonstandard_branches(tmpdir: Any) -> None:
 
     repo.update()
 
-    assert set(repo._refspecs_to_pull()) == {
+    assert set(repo._refspecs_to_pull) == {
         "refs/heads/main:refs/remotes/origin/main",
         "refs/heads/test-branch:refs/remotes/origin/test-branch",
     }
@@ -204,3 +209,343 @@ def test_changed_files_since_first_commit() -> None:
     file_list = repo.changed_files(None, "10143b638f2a3b0316b97a5f959d9f2eaa6776af")
 
     assert file_list == {"README.md"}
+
+
+def test_available_branches_queries_only_wanted_branches_and_caches(mocker: Any) -> None:
+    repo = GitHubRepo(
+        location=None,
+        parent_dir=str(TESTDIR),
+        repourl="https://github.com/octocat/Spoon-Knife.git",
+        branches_to_fetch={"main", "missing"},
+    )
+
+    def get_branch(name: str) -> Any:
+        if name == "missing":
+            raise UnknownObjectException(404)
+        return mocker.MagicMock()
+
+    gh_repo = mocker.MagicMock()
+    gh_repo.get_branch.side_effect = get_branch
+    mocker.patch.object(repo, "get_github_repo", return_value=gh_repo)
+
+    assert repo._available_branches() == {"main"}
+    assert gh_repo.get_branch.call_count == 2
+    gh_repo.get_branches.assert_not_called()
+
+    # A second call within the TTL is answered from the cache.
+    repo.branches_to_fetch = {"main"}
+    assert repo._available_branches() == {"main"}
+    assert gh_repo.get_branch.call_count == 2
+
+
+def test_installation_and_repo_lookups_are_shared_between_instances(mocker: Any) -> None:
+    mocker.patch.dict(GitHubRepo._installation_cache, clear=True)
+    mocker.patch.dict(GitHubRepo._repo_cache, clear=True)
+    mocker.patch("configscanning.githubrepo.Auth.AppAuth")
+    ghi_class = mocker.patch("configscanning.githubrepo.GithubIntegration")
+    gh_installation = ghi_class.return_value.get_repo_installation.return_value
+    github = gh_installation.get_github_for_installation.return_value
+    github._Github__requester.auth.token = "token"
+
+    repos = [
+        GitHubRepo(location=None, parent_dir=str(TESTDIR), repourl=f"https://github.com/org/repo{i}.git")
+        for i in range(2)
+    ]
+    for repo in repos:
+        assert repo.authenticate_to_github(1234, "key") is github
+        assert repo._access_token == "token"
+        repo.get_github_repo()
+
+    ghi_class.return_value.get_repo_installation.assert_called_once_with("org", "repo0")
+    assert github.get_repo.call_count == 2
+
+    # A new instance for an already-seen repo reuses the Repository object.
+    repo = GitHubRepo(location=None, parent_dir=str(TESTDIR), repourl="https://github.com/org/repo1.git")
+    repo.authenticate_to_github(1234, "key")
+    assert repo.get_github_repo(refresh=True) is github.get_repo.return_value
+    assert github.get_repo.call_count == 2
+    github.get_repo.return_value.update.assert_called_once()
+
+
+def test_get_github_repo_refreshes_object_already_held(mocker: Any) -> None:
+    mocker.patch.dict(GitHubRepo._repo_cache, clear=True)
+    repo = GitHubRepo(location=None, parent_dir=str(TESTDIR), repourl="https://github.com/org/repo.git")
+    github = mocker.MagicMock()
+    repo._github = github
+    gh_repo = github.get_repo.return_value
+
+    # A freshly fetched object doesn't need refreshing.
+    assert repo.get_github_repo(refresh=True) is gh_repo
+    gh_repo.update.assert_not_called()
+
+    assert repo.get_github_repo() is gh_repo
+    gh_repo.update.assert_not_called()
+
+    assert repo.get_github_repo(refresh=True) is gh_repo
+    gh_repo.update.assert_called_once()
+    github.get_repo.assert_called_once()
+
+
+def _commit_file(upstream: pygit2.Repository, branch: str, fname: str, content: str | None) -> pygit2.Oid:
+    """
+    Adds a commit setting fname to content (or deleting it, if content is None) on top of branch in
+    the (bare) repo upstream.
+    """
+    ref = f"refs/heads/{branch}"
+    parents = [upstream.references[ref].target] if ref in upstream.references else []
+    builder = upstream.TreeBuilder(upstream[parents[0]].peel(pygit2.Tree)) if parents else upstream.TreeBuilder()
+    if content is None:
+        builder.remove(fname)
+    else:
+        builder.insert(fname, upstream.create_blob(content.encode()), pygit2.GIT_FILEMODE_BLOB)
+    sig = pygit2.Signature("Test", "test@example.com")
+    return upstream.create_commit(ref, sig, sig, f"Set {fname}", builder.write(), parents)
+
+
+@pytest.fixture
+def local_upstream(tmp_path: Path, mocker: Any) -> tuple[pygit2.Repository, GitHubRepo]:
+    """A bare repo on local disk with branches 'main' and 'develop', and a GitHubRepo cloning it."""
+    upstream = pygit2.init_repository(str(tmp_path / "upstream" / "org" / "repo.git"), bare=True)
+    _commit_file(upstream, "main", "README.md", "main")
+    _commit_file(upstream, "develop", "README.md", "develop")
+
+    repo = GitHubRepo(
+        location=tmp_path / "clones" / "org" / "repo",
+        repourl=f"file://{tmp_path}/upstream/org/repo.git",
+        branches_to_fetch={"main", "develop"},
+    )
+    mocker.patch.object(repo, "_available_branches", side_effect=lambda: set(repo.branches_to_fetch))
+    return upstream, repo
+
+
+def test_update_clones_and_fast_forwards_local_repo(local_upstream: tuple[pygit2.Repository, GitHubRepo]) -> None:
+    upstream, repo = local_upstream
+
+    repo.update()
+    assert repo.repo is not None
+    assert {name: pos["summary"] for name, pos in repo.ref_positions().items()} == {
+        "refs/heads/main": "Set README.md",
+        "refs/heads/develop": "Set README.md",
+    }
+
+    _commit_file(upstream, "develop", "gone.txt", "soon deleted")
+    repo.update()
+    repo.checkout_and_reset("refs/heads/develop")
+    assert (repo.location / "gone.txt").exists()
+
+    _commit_file(upstream, "develop", "README.md", "changed")
+    _commit_file(upstream, "develop", "gone.txt", None)
+    new_develop = _commit_file(upstream, "develop", "new.yaml", "a: 1")
+    new_main = _commit_file(upstream, "main", "other.yaml", "b: 2")
+
+    repo.update()
+    assert repo.ref_positions()["refs/heads/develop"]["hash"] == new_develop
+    assert repo.ref_positions()["refs/heads/main"]["hash"] == new_main
+
+    # We stay on the branch we were on, and the working tree matches its new commit.
+    assert repo.repo.head.shorthand == "develop"
+    assert (repo.location / "README.md").read_text() == "changed"
+    assert not (repo.location / "gone.txt").exists()
+    assert (repo.location / "new.yaml").exists()
+    assert repo.repo.status() == {}
+
+
+def test_changed_files_since_commit(local_upstream: tuple[pygit2.Repository, GitHubRepo]) -> None:
+    upstream, repo = local_upstream
+    repo.update()
+    first_main = repo.ref_positions()["refs/heads/main"]["hash"]
+
+    _commit_file(upstream, "main", "config.yaml", "a: 1")
+    _commit_file(upstream, "main", "notes.txt", "text")
+    repo.update()
+
+    assert repo.changed_files(str(first_main), "refs/heads/main") == {"config.yaml", "notes.txt"}
+    assert repo.changed_files(str(first_main), "refs/heads/main", only_matching=re.compile(r"\.yaml\Z")) == {
+        "config.yaml"
+    }
+    assert repo.changed_files(None, "refs/heads/main") == {"README.md", "config.yaml", "notes.txt"}
+
+
+def test_changed_files_with_regex(local_upstream: tuple[pygit2.Repository, GitHubRepo]) -> None:
+    upstream, repo = local_upstream
+    _commit_file(upstream, "main", "config.yaml", "a: 1")
+    _commit_file(upstream, "main", "notes.txt", "text")
+    repo.update()
+
+    assert repo.changed_files(None, "refs/heads/main", only_matching=re.compile(r"\.(yaml|txt)$")) == {
+        "config.yaml",
+        "notes.txt",
+    }
+    assert repo.changed_files(None, "refs/heads/main", only_matching=lambda f: f.endswith(".md")) == {"README.md"}
+
+
+def test_shallow_depth_is_passed_to_fetch(local_upstream: tuple[pygit2.Repository, GitHubRepo], mocker: Any) -> None:
+    # libgit2's local transport doesn't support shallow fetches, so we can only check we ask for one.
+    _, repo = local_upstream
+    real_fetch = pygit2.remotes.Remote.fetch
+
+    def unshallow_fetch(remote: pygit2.remotes.Remote, **kwargs: Any) -> Any:
+        kwargs["depth"] = 0
+        return real_fetch(remote, **kwargs)
+
+    fetch = mocker.patch.object(pygit2.remotes.Remote, "fetch", autospec=True, side_effect=unshallow_fetch)
+    repo.shallow_depth = 1
+
+    repo.update()
+
+    assert fetch.call_args.kwargs["depth"] == 1
+    assert set(fetch.call_args.kwargs["refspecs"]) == {
+        "refs/heads/main:refs/remotes/origin/main",
+        "refs/heads/develop:refs/remotes/origin/develop",
+    }
+
+
+def test_repo_handles_are_shared_until_clone_deleted(local_upstream: tuple[pygit2.Repository, GitHubRepo]) -> None:
+    _, repo = local_upstream
+    repo.update()
+
+    def new_instance() -> GitHubRepo:
+        return GitHubRepo(location=repo.location, repourl=repo.repourl)
+
+    assert new_instance().repo is new_instance().repo
+
+    with repo.lock:
+        repo.delete_clone()
+    assert repo.repo is None
+    assert not repo.location.exists()
+    assert new_instance().repo is None
+
+
+def test_repo_lock_is_reentrant_and_excludes_other_holders(tmp_path: Path) -> None:
+    fcntl = pytest.importorskip("fcntl")
+    repo = GitHubRepo(parent_dir=tmp_path, repourl="https://github.com/octocat/Spoon-Knife.git")
+    lock_file = tmp_path / "_AIPIPE_LOCK_github.com-octocat-Spoon-Knife"
+
+    def lock_is_free() -> bool:
+        with open(lock_file) as other:
+            try:
+                fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            fcntl.flock(other, fcntl.LOCK_UN)
+            return True
+
+    with repo.lock:
+        with repo.lock:
+            assert not lock_is_free()
+        assert not lock_is_free()
+    assert lock_is_free()
+
+
+def test_update_all_updates_every_repo(tmp_path: Path) -> None:
+    upstreams = []
+    repos = []
+    for name in ("one", "two"):
+        upstream = pygit2.init_repository(str(tmp_path / "upstream" / "org" / f"{name}.git"), bare=True)
+        upstreams.append(_commit_file(upstream, "main", "README.md", name))
+        repo = GitHubRepo(
+            location=tmp_path / "clones" / "org" / name, repourl=f"file://{tmp_path}/upstream/org/{name}.git"
+        )
+        repo._available_branches = lambda: {"main"}
+        repos.append(repo)
+
+    asyncio.run(update_all(repos))
+
+    assert [repo.ref_positions()["refs/heads/main"]["hash"] for repo in repos] == upstreams
+
+
+def test_update_skips_fetch_when_up_to_date(local_upstream: tuple[pygit2.Repository, GitHubRepo], mocker: Any) -> None:
+    upstream, repo = local_upstream
+    repo.update()
+    fetch = mocker.spy(pygit2.remotes.Remote, "fetch")
+
+    repo.update()
+    fetch.assert_not_called()
+
+    new_main = _commit_file(upstream, "main", "config.yaml", "a: 1")
+    repo.update()
+    fetch.assert_called_once()
+    assert repo.ref_positions()["refs/heads/main"]["hash"] == new_main
+
+    repo.update(check_before_fetch=False)
+    assert fetch.call_count == 2
+
+
+def test_delete_clone_refuses_symlinked_location(tmp_path: Path) -> None:
+    target = tmp_path / "elsewhere"
+    target.mkdir()
+    (target / "keep.txt").write_text("keep")
+    (tmp_path / "github.com" / "octocat").mkdir(parents=True)
+    location = tmp_path / "github.com" / "octocat" / "Spoon-Knife"
+    location.symlink_to(target)
+
+    repo = GitHubRepo(location=location, repourl="https://github.com/octocat/Spoon-Knife.git")
+    with repo.lock, pytest.raises(OSError, match="Spoon-Knife"):
+        repo.delete_clone()
+
+    assert (target / "keep.txt").exists()
+
+
+def test_update_fetches_many_branches_in_one_fetch(
+    local_upstream: tuple[pygit2.Repository, GitHubRepo], mocker: Any
+) -> None:
+    upstream, repo = local_upstream
+    branches = {f"branch{i}" for i in range(12)}
+    tips = {f"refs/heads/{branch}": _commit_file(upstream, branch, "README.md", branch) for branch in branches}
+    repo.branches_to_fetch = branches
+    fetch = mocker.spy(pygit2.remotes.Remote, "fetch")
+
+    repo.update()
+
+    fetch.assert_called_once()
+    assert {name: pos["hash"] for name, pos in repo.ref_positions().items()} == tips
+
+    # Every fetched commit, and the blobs its tree refers to, can be read back.
+    assert repo.repo is not None
+    for branch in branches:
+        commit = repo.repo.get(tips[f"refs/heads/{branch}"])
+        assert isinstance(commit, pygit2.Commit)
+        blob = repo.repo.get(commit.tree["README.md"].id)
+        assert isinstance(blob, pygit2.Blob)
+        assert blob.data == branch.encode()
+
+
+def test_update_uses_current_token_of_cached_client(
+    local_upstream: tuple[pygit2.Repository, GitHubRepo], mocker: Any
+) -> None:
+    upstream, repo = local_upstream
+    mocker.patch.dict(GitHubRepo._installation_cache, clear=True)
+    github = mocker.MagicMock()
+    github._Github__requester.auth.token = "first-token"
+    GitHubRepo._installation_cache[(1234, repo.gh_org)] = github
+    user_pass = mocker.spy(pygit2, "UserPass")
+
+    repo.authenticate_to_github(1234, "key")
+    repo.update()
+    user_pass.assert_called_once_with("none", "first-token")
+
+    # The shared client refreshes its token, eg because it was about to expire.
+    github._Github__requester.auth.token = "second-token"
+    _commit_file(upstream, "main", "config.yaml", "a: 1")
+    list_heads = mocker.spy(pygit2.remotes.Remote, "list_heads")
+    fetch = mocker.spy(pygit2.remotes.Remote, "fetch")
+    repo.update()
+
+    user_pass.assert_called_with("none", "second-token")
+    new_callbacks = repo._get_remote_callbacks()
+    assert list_heads.call_args.kwargs["callbacks"] is new_callbacks
+    assert fetch.call_args.kwargs["callbacks"] is new_callbacks
+
+
+def test_remote_callbacks_are_reused_until_token_is_refreshed(mocker: Any) -> None:
+    repo = GitHubRepo(location=None, parent_dir=str(TESTDIR), repourl="https://github.com/org/repo.git")
+    repo._app_id = 1234
+    github = mocker.MagicMock()
+    github._Github__requester.auth.token = "first-token"
+    repo._github = github
+
+    callbacks = repo._get_remote_callbacks()
+    assert repo._get_remote_callbacks() is callbacks
+
+    github._Github__requester.auth.token = "second-token"
+    assert repo._get_remote_callbacks() is not callbacks
@@ -0,0 +1,45 @@
+import argparse
+from pathlib import Path
+from typing import Any
+
+import pytest
+from pytest_mock import MockerFixture
+
+from configscanning import k8sutils
+
+
+def test_init_k8s_shares_client_and_resource_discovery(mocker: MockerFixture) -> None:
+    mocker.patch("kubernetes.config")
+    api_client = mocker.patch("kubernetes.client.ApiClient")
+    dyn_mock = mocker.patch("kubernetes.dynamic.DynamicClient")
+    mocker.patch.object(k8sutils, "_API_CLIENT", None)
+    mocker.patch.object(k8sutils, "_DYNAMIC_CLIENT", None)
+    mocker.patch.dict(k8sutils._RESOURCES, clear=True)
+
+    k8sutils.init_k8s()
+
+    apis: list[Any] = []
+    for kind in ("Workspace", "Workspace", "Repo"):
+        with k8sutils.aipipe_resource_dclient(kind) as api:
+            apis.append(api)
+
+    assert apis[0] is apis[1]
+    api_client.assert_called_once_with()
+    dyn_mock.assert_called_once_with(api_client.return_value)
+    assert dyn_mock.return_value.resources.get.call_count == 2
+
+
+def test_load_gh_app_creds_reads_files_or_falls_back_to_env(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (tmp_path / "GITHUB_APP_ID").write_text("1234\n")
+    (tmp_path / "GITHUB_APP_PRIVATE_KEY").write_text("-----KEY-----\n")
+    monkeypatch.setenv("GITHUB_APP_ID", "5678")
+    monkeypatch.setenv("GITHUB_APP_PRIVATE_KEY", "envkey")
+    k8sutils._load_gh_app_creds.cache_clear()
+
+    from_files = argparse.Namespace(
+        app_id_from=str(tmp_path / "GITHUB_APP_ID"), app_private_key_from=str(tmp_path / "GITHUB_APP_PRIVATE_KEY")
+    )
+    assert k8sutils.load_gh_app_creds(from_files) == (1234, "-----KEY-----\n")
+
+    from_env = argparse.Namespace(app_id_from=str(tmp_path / "none"), app_private_key_from=str(tmp_path / "none"))
+    assert k8sutils.load_gh_app_creds(from_env) == ("5678", "envkey")
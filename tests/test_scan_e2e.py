@@ -12,6 +12,31 @@ import configscanning.scanners.filelister
 from configscanning.githubrepo import GitHubRepo
 
 
+def test_scan_lists_files_into_caller_supplied_sink(tmp_path: Path) -> None:
+    location = tmp_path / "github.com" / "org" / "repo"
+    local = pygit2.init_repository(str(location), initial_head="main")
+    (location / "config.yaml").write_text("a: 1\n")
+    (location / "notes.txt").write_text("notes")
+    local.index.add_all()
+    local.index.write()
+    sig = pygit2.Signature("Test", "test@example.com")
+    local.create_commit("refs/heads/main", sig, sig, "Add files", local.index.write_tree(), [])
+    (tmp_path / "github.com" / "org" / "repo.upstream_push_time").write_text("1234")
+
+    repo = GitHubRepo(location=location, repourl="https://github.com/org/repo.git")
+    sink: list[Any] = []
+    configscanning.scanners.filelister.visited_files = []
+
+    configscanning.git_change_scanner.config_scan(
+        repo,
+        {"main": {configscanning.scanners.filelister.Scanner(sink=sink)}},
+        scan_filter=lambda f: f.endswith(".yaml"),
+    )
+
+    assert sink == [Path("config.yaml")]
+    assert configscanning.scanners.filelister.visited_files == []
+
+
 @pytest.mark.integrationtest
 def test_scan_for_yaml(tmpdir: Any) -> None:
     repo = GitHubRepo(